@@ -1,8 +1,15 @@
+import io
 import os
+import codecs
 import re
+import html
+import asyncio
+import hashlib
+import aiohttp
+import orjson
 import feedparser
-import requests
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
+from urllib.parse import quote
 from datetime import datetime, timezone
 from supabase import create_client
 
@@ -73,17 +80,43 @@ CATEGORY_MAPPING = {
 }
 
 HEADERS = {
-    "User-Agent": "Mozilla/5.0 (NabaAI Bot)"
+    "User-Agent": "Mozilla/5.0 (NabaAI Bot)",
+    "Accept-Encoding": "gzip, deflate",
 }
 
+MAX_ENTRIES = 15  # عدد الأخبار المأخوذة من كل خلاصة
+
+QUERY_CHUNK = 100  # عدد القيم في كل استعلام in_ أو الصفوف في كل دفعة حفظ
+
+MAX_FILTER_CHARS = 4000  # طول قيم in_ بعد ترميزها في الرابط (العربية تتضاعف)
+
 MAX_CHARS = 2000  # لتسريع إرسال النص إلى API
 
+HF_JSON_HEADERS = {"Content-Type": "application/json"}
+
+HF_BATCH_SIZE = 16  # عدد النصوص في كل طلب تصنيف
+
+MAX_CONCURRENT_FETCHES = 20  # أقصى عدد طلبات مقالات في نفس الوقت
+
+MAX_BYTES = 512 * 1024  # لا نحتاج أكثر من بداية الصفحة لاستخراج النص
+
+OG_SCAN_BYTES = 16 * 1024  # og:image يكون عادة في بداية <head>
+
+_OG_RE = re.compile(
+    rb'<meta[^>]+property=["\']og:image["\'][^>]+content=["\']([^"\']+)',
+    re.I
+)
+
 # =============================
 # INIT
 # =============================
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+_prediction_cache = {}  # تصنيفات هذا التشغيل حسب hash النص
+
+_hf_batch_supported = True  # يصبح False بعد أول رفض للقوائم من الـ API
+
 # =============================
 # HELPERS
 # =============================
@@ -92,75 +125,304 @@ def now_utc():
     return datetime.now(timezone.utc).isoformat()
 
 def clean_text(text: str) -> str:
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    # split() بدون معامل يطوي كل مسافات Unicode داخل C مباشرة
+    return " ".join(text.split())
 
 # 🔥 التصنيف عبر HuggingFace API
-def classify(text: str) -> str:
+async def classify(session, semaphore, text: str) -> str:
     try:
         short_text = text[:MAX_CHARS]
 
-        response = requests.post(
-            HF_API_URL,
-            json={"text": short_text},
-            timeout=30
-        )
+        async with semaphore:
+            async with session.post(
+                HF_API_URL,
+                data=orjson.dumps({"text": short_text}),
+                headers=HF_JSON_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                response.raise_for_status()
+                data = orjson.loads(await response.read())
+
+        return normalize_prediction(data)
+
+    except Exception as e:
+        print("⚠️ HF API classification failed:", e)
+        return "unknown"
+
+def normalize_prediction(data) -> str:
+    if isinstance(data, dict):
+        data = data.get("prediction") or data.get("label")
+
+    if not data or not isinstance(data, str):
+        return "unknown"
+
+    return data.lower().strip()
 
-        response.raise_for_status()
-        data = response.json()
+def content_hash(text: str) -> str:
+    short_text = text[:MAX_CHARS]
+    return hashlib.blake2b(short_text.encode(), digest_size=16).hexdigest()
 
-        prediction = data.get("prediction") or data.get("label")
+def cached_predictions(hashes: list) -> dict:
+    cached = {}
 
-        if not prediction:
-            return "unknown"
+    for i in range(0, len(hashes), QUERY_CHUNK):
+        try:
+            res = supabase.table("classifications") \
+                .select("content_hash,prediction") \
+                .in_("content_hash", hashes[i:i + QUERY_CHUNK]) \
+                .execute()
+            cached.update(
+                {r["content_hash"]: r["prediction"] for r in res.data}
+            )
 
-        return prediction.lower().strip()
+        except Exception as e:
+            print("⚠️ Classification cache lookup failed:", e)
+
+    return cached
+
+def store_predictions(predictions: dict):
+    if not predictions:
+        return
+
+    try:
+        supabase.table("classifications").upsert([
+            {"content_hash": h, "prediction": p}
+            for h, p in predictions.items()
+        ], on_conflict="content_hash").execute()
 
     except Exception as e:
-        print("⚠️ HF API classification failed:", e)
-        return "unknown"
+        print("⚠️ Classification cache store failed:", e)
 
-def already_exists(title: str) -> bool:
-    res = supabase.table("news") \
-        .select("id") \
-        .eq("title", title) \
-        .limit(1) \
-        .execute()
-    return bool(res.data)
+# 🔥 نرسل للـ API فقط النصوص التي لم تُصنّف من قبل (في هذا التشغيل أو في Supabase)
+async def classify_many(session, semaphore, texts: list) -> list:
+    hashes = [content_hash(t) for t in texts]
+
+    misses = list(dict.fromkeys(h for h in hashes if h not in _prediction_cache))
+    if misses:
+        _prediction_cache.update(cached_predictions(misses))
+
+    to_classify = {}
+    for h, text in zip(hashes, texts):
+        if h not in _prediction_cache:
+            to_classify.setdefault(h, text)
+
+    if to_classify:
+        results = await post_batches(
+            session, semaphore, list(to_classify.values())
+        )
+        predictions = dict(zip(to_classify, results))
+        _prediction_cache.update(predictions)
+        store_predictions({h: p for h, p in predictions.items() if p != "unknown"})
+
+    return [_prediction_cache[h] for h in hashes]
+
+def disable_hf_batches(reason):
+    global _hf_batch_supported
+
+    if _hf_batch_supported:
+        _hf_batch_supported = False
+        print("⚠️ HF API rejected batched input, classifying one by one:", reason)
+
+async def classify_each(session, semaphore, batch: list) -> list:
+    return await asyncio.gather(
+        *[classify(session, semaphore, t) for t in batch]
+    )
+
+# 🔥 تصنيف عدة نصوص في طلب واحد، مع الرجوع لطلب لكل نص إن رفض الـ API القوائم
+async def post_batch(session, semaphore, batch: list) -> list:
+    if not _hf_batch_supported:
+        return await classify_each(session, semaphore, batch)
+
+    try:
+        async with semaphore:
+            async with session.post(
+                HF_API_URL,
+                data=orjson.dumps({"text": batch}),
+                headers=HF_JSON_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                response.raise_for_status()
+                data = orjson.loads(await response.read())
+
+        if isinstance(data, dict):
+            data = data.get("predictions") or data.get("labels")
+
+        if not isinstance(data, list) or len(data) != len(batch):
+            raise ValueError("batch response does not match request")
 
-def get_or_create_source(name: str) -> int:
+        return [normalize_prediction(d) for d in data]
+
+    except aiohttp.ClientResponseError as e:
+        if 400 <= e.status < 500:
+            disable_hf_batches(e)
+        else:
+            print("⚠️ HF API batch classification failed, falling back:", e)
+
+    except ValueError as e:
+        disable_hf_batches(e)
+
+    except Exception as e:
+        print("⚠️ HF API batch classification failed, falling back:", e)
+
+    return await classify_each(session, semaphore, batch)
+
+async def post_batches(session, semaphore, texts: list) -> list:
+    batches = [
+        [t[:MAX_CHARS] for t in texts[i:i + HF_BATCH_SIZE]]
+        for i in range(0, len(texts), HF_BATCH_SIZE)
+    ]
+
+    if not batches:
+        return []
+
+    # الدفعة الأولى وحدها تكشف هل يقبل الـ API القوائم قبل إرسال البقية
+    first = await post_batch(session, semaphore, batches[0])
+    rest = await asyncio.gather(
+        *[post_batch(session, semaphore, batch) for batch in batches[1:]]
+    )
+
+    return [p for batch in [first, *rest] for p in batch]
+
+def in_filter(values: list) -> str:
+    # نقتبس كل قيمة بأنفسنا: in_() في postgrest لا يهرّب " داخل القيمة
+    quoted = (
+        '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for v in values
+    )
+    return "(" + ",".join(quoted) + ")"
+
+def entry_guid(item) -> str:
+    # المعرّف الثابت من الخلاصة (guid/id)، وإلا الرابط
+    return item.get("id") or item.get("guid") or item.get("link")
+
+def filter_chunks(values: list):
+    # نقسم حسب طول القيم بعد ترميزها في الرابط وليس حسب عددها،
+    # فالعناوين والروابط ذات الأسماء العربية تطول كثيراً
+    chunk = []
+    size = 0
+
+    for value in values:
+        length = len(quote(in_filter([value]), safe=""))
+
+        if chunk and size + length > MAX_FILTER_CHARS:
+            yield chunk
+            chunk = []
+            size = 0
+
+        chunk.append(value)
+        size += length
+
+    if chunk:
+        yield chunk
+
+def existing_guids(keys: list) -> set:
+    # guid فريد داخل المصدر فقط، لذلك نعيد أزواج (source_id, guid)
+    existing = set()
+    failed = set()
+
+    for chunk in filter_chunks(list({guid for _, guid in keys})):
+        try:
+            res = supabase.table("news") \
+                .select("source_id,guid") \
+                .filter("guid", "in", in_filter(chunk)) \
+                .execute()
+            existing.update((r["source_id"], r["guid"]) for r in res.data)
+
+        except Exception as e:
+            # نعتبرها موجودة حتى لا نكرر الأخبار؛ تُعاد المحاولة في التشغيل التالي
+            print(f"⚠️ Guid lookup failed, skipping {len(chunk)} entries:", e)
+            failed.update(chunk)
+
+    return existing | {key for key in keys if key[1] in failed}
+
+def existing_titles(titles: list) -> set:
+    existing = set()
+
+    for chunk in filter_chunks(titles):
+        try:
+            res = supabase.table("news") \
+                .select("title") \
+                .filter("title", "in", in_filter(chunk)) \
+                .execute()
+            existing.update(r["title"] for r in res.data)
+
+        except Exception as e:
+            # نعتبرها موجودة حتى لا نكرر الأخبار؛ تُعاد المحاولة في التشغيل التالي
+            print(f"⚠️ Title lookup failed, skipping {len(chunk)} entries:", e)
+            existing.update(chunk)
+
+    return existing
+
+def load_source_ids() -> dict:
     res = supabase.table("sources") \
-        .select("id") \
-        .eq("name", name) \
-        .limit(1) \
+        .select("id,name") \
+        .in_("name", list(RSS_SOURCES)) \
         .execute()
 
-    if res.data:
-        return res.data[0]["id"]
+    source_ids = {r["name"]: r["id"] for r in res.data}
+
+    missing = [name for name in RSS_SOURCES if name not in source_ids]
+    if missing:
+        ins = supabase.table("sources").insert([
+            {"name": name, "source_type_id": 1}
+            for name in missing
+        ]).execute()
 
-    ins = supabase.table("sources").insert({
-        "name": name,
-        "source_type_id": 1
-    }).execute()
+        source_ids.update({r["name"]: r["id"] for r in ins.data})
 
-    return ins.data[0]["id"]
+    return source_ids
 
 # =============================
 # ARTICLE SCRAPER
 # =============================
 
-def fetch_full_article(url: str):
+def find_og_image(body: bytes):
+    match = _OG_RE.search(body, 0, OG_SCAN_BYTES)
+    if not match:
+        return None
+
+    return html.unescape(match.group(1).decode("utf-8", "replace"))
+
+def normalize_charset(charset):
+    # بعض الخوادم ترسل قيماً غير صالحة مثل "none" أو "utf-8;"
+    if not charset:
+        return None
+
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+async def read_capped(response, limit: int) -> bytes:
+    chunks = []
+    size = 0
+
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+
+    return b"".join(chunks)[:limit]
+
+async def fetch_full_article(session, url: str):
     try:
-        r = requests.get(url, headers=HEADERS, timeout=20)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=20)) as r:
+            r.raise_for_status()
+            body = await read_capped(r, MAX_BYTES)
+            charset = normalize_charset(r.charset)
 
-        paragraphs = soup.find_all("p")
-        content = " ".join(p.get_text() for p in paragraphs)
+        # نمرر bytes مباشرة؛ الترميز من ترويسة HTTP إن وجد وإلا يكتشفه lxml
+        parser = lxml_html.HTMLParser(encoding=charset) if charset else None
+        doc = lxml_html.fromstring(body, parser=parser)
+
+        content = " ".join(doc.xpath("//p//text()"))
         content = clean_text(content)
 
-        img = soup.find("meta", property="og:image")
-        image_url = img["content"] if img else None
+        image_url = find_og_image(body)
+        if not image_url:
+            imgs = doc.xpath('//meta[@property="og:image"]/@content')
+            image_url = imgs[0] if imgs else None
 
         return content, image_url
 
@@ -168,57 +430,227 @@ def fetch_full_article(url: str):
         print("⚠️ Article fetch failed:", e)
         return None, None
 
+# =============================
+# RSS PARSER
+# =============================
+
+def item_text(item, tag: str):
+    text = item.findtext(tag)
+    return text.strip() if text and text.strip() else None
+
+def parse_rss_items(body: bytes):
+    # نقرأ أول MAX_ENTRIES عناصر <item> فقط؛ None إن لم تكن الخلاصة RSS 2.0
+    entries = []
+    context = etree.iterparse(
+        io.BytesIO(body),
+        events=("start", "end"),
+        resolve_entities=False,
+        no_network=True
+    )
+
+    for event, el in context:
+        if event == "start":
+            if not entries and el.getparent() is None and el.tag != "rss":
+                return None
+            continue
+
+        if el.tag != "item":
+            continue
+
+        entries.append({
+            "title": item_text(el, "title"),
+            "link": item_text(el, "link"),
+            "id": item_text(el, "guid"),
+        })
+        el.clear()
+
+        if len(entries) >= MAX_ENTRIES:
+            break
+
+    return entries
+
+def parse_feed(body: bytes) -> list:
+    try:
+        entries = parse_rss_items(body)
+    except etree.XMLSyntaxError:
+        entries = None
+
+    # Atom/RDF أو XML غير سليم: نترك المهمة لـ feedparser
+    if entries is None:
+        return feedparser.parse(body).entries[:MAX_ENTRIES]
+
+    return entries
+
 # =============================
 # MAIN
 # =============================
 
-def main():
-    added = 0
+async def fetch_feed(session, semaphore, url: str) -> bytes:
+    async with semaphore:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=20)) as r:
+            r.raise_for_status()
+            return await r.read()
+
+async def fetch_feeds(session, semaphore) -> dict:
+    # نحمّل كل الخلاصات عبر نفس جلسة aiohttp ثم نحللها خارج الـ event loop
+    async def fetch_one(rss_url):
+        body = await fetch_feed(session, semaphore, rss_url)
+        return await asyncio.to_thread(parse_feed, body)
+
+    names = list(RSS_SOURCES)
+    results = await asyncio.gather(
+        *[fetch_one(RSS_SOURCES[name]) for name in names],
+        return_exceptions=True
+    )
+
+    feeds = {}
+    for source_name, res in zip(names, results):
+        if isinstance(res, BaseException):
+            print(f"⚠️ RSS fetch failed ({source_name}):", res)
+            continue
+        feeds[source_name] = res
+
+    return feeds
+
+# 1) جمع الأخبار من كل الخلاصات
+async def collect_entries(session, semaphore, source_ids: dict) -> list:
+    feeds = await fetch_feeds(session, semaphore)
+    entries = []
+
+    for source_name, items in feeds.items():
+        print(f"📡 {source_name}: {len(items)} entries")
+
+        for item in items:
+            entries.append({
+                "guid": entry_guid(item),
+                "title": item.get("title"),
+                "link": item.get("link"),
+                "source_id": source_ids[source_name],
+            })
+
+    return entries
+
+# 2) استبعاد الناقص والمكرر والموجود مسبقاً باستعلام واحد لكل دفعة
+def dedup(entries: list) -> list:
+    # الخبر جديد فقط إن لم يُحفظ (source_id, guid) ولا العنوان من قبل،
+    # فالعنوان يلتقط نفس الخبر من مصدرين والصفوف القديمة بلا guid
+    unique = {}
+
+    for entry in entries:
+        if not entry["title"] or not entry["link"]:
+            continue
+        unique.setdefault((entry["source_id"], entry["guid"]), entry)
+
+    existing = existing_guids(list(unique))
+    stored_titles = existing_titles(list({e["title"] for e in unique.values()}))
+
+    new_entries = []
+    seen_titles = set()
+
+    for key, entry in unique.items():
+        title = entry["title"]
+
+        if key in existing or title in stored_titles or title in seen_titles:
+            continue
+
+        seen_titles.add(title)
+        new_entries.append(entry)
+
+    return new_entries
+
+# 3) جلب المقالات بالتوازي مع حد أقصى للطلبات المتزامنة
+async def fetch_all(session, semaphore, entries: list) -> list:
+    async def fetch_one(link):
+        async with semaphore:
+            return await fetch_full_article(session, link)
+
+    results = await asyncio.gather(
+        *[fetch_one(e["link"]) for e in entries],
+        return_exceptions=True
+    )
+
+    items = []
+    for entry, res in zip(entries, results):
+        if isinstance(res, BaseException):
+            continue
+
+        content, image_url = res
+        if not content or len(content) < 300:
+            continue
 
-    for source_name, rss_url in RSS_SOURCES.items():
-        print(f"\n📡 Fetching from {source_name}")
-        feed = feedparser.parse(rss_url)
-        source_id = get_or_create_source(source_name)
+        items.append({
+            "guid": entry["guid"],
+            "title": entry["title"],
+            "content": content,
+            "primary_image": image_url,
+            "source_id": entry["source_id"],
+            "is_external": True,
+            "published_at": now_utc(),
+        })
 
-        for item in feed.entries[:15]:
-            title = item.get("title")
-            link = item.get("link")
+    return items
 
-            if not title or not link:
-                continue
+def apply_category(row: dict, predicted_raw: str):
+    mapped_category = CATEGORY_MAPPING.get(predicted_raw)
 
-            if already_exists(title):
-                continue
+    row["status"] = "pending"
+    row["category_id"] = None
 
-            content, image_url = fetch_full_article(link)
-            if not content or len(content) < 300:
-                continue
+    if mapped_category and mapped_category in ALLOWED_CATEGORIES:
+        row["category_id"] = ALLOWED_CATEGORIES[mapped_category]
+        row["status"] = "published"
 
-            predicted_raw = classify(content)
-            mapped_category = CATEGORY_MAPPING.get(predicted_raw)
+# 4) تصنيف كل المقالات دفعة واحدة
+async def classify_all(session, semaphore, items: list) -> list:
+    predictions = await classify_many(
+        session, semaphore, [item["content"] for item in items]
+    )
 
-            status = "pending"
-            category_id = None
+    for row, predicted_raw in zip(items, predictions):
+        apply_category(row, predicted_raw)
 
-            if mapped_category and mapped_category in ALLOWED_CATEGORIES:
-                category_id = ALLOWED_CATEGORIES[mapped_category]
-                status = "published"
+    return items
 
-            supabase.table("news").insert({
-                "title": title,
-                "content": content,
-                "primary_image": image_url,
-                "category_id": category_id,
-                "source_id": source_id,
-                "status": status,
-                "is_external": True,
-                "published_at": now_utc(),
-            }).execute()
+# 5) حفظ كل الصفوف؛ (source_id, guid) فريد فإعادة التشغيل لا تكرر الأخبار
+def insert_all(rows: list) -> list:
+    added = []
 
-            added += 1
-            print(f"✅ Added ({status}): {title}")
+    # دفعة فاشلة لا تضيّع بقية الصفوف
+    for i in range(0, len(rows), QUERY_CHUNK):
+        chunk = rows[i:i + QUERY_CHUNK]
 
-    print(f"\n🎉 DONE. Total added: {added}")
+        try:
+            res = supabase.table("news") \
+                .upsert(chunk, on_conflict="source_id,guid", ignore_duplicates=True) \
+                .execute()
+            added.extend(res.data)
+
+        except Exception as e:
+            print(f"⚠️ Insert failed for {len(chunk)} rows:", e)
+
+    return added
+
+async def run():
+    source_ids = load_source_ids()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        entries = await collect_entries(session, semaphore, source_ids)
+        entries = dedup(entries)
+        print(f"\n🆕 New entries: {len(entries)}")
+
+        items = await fetch_all(session, semaphore, entries)
+        rows = await classify_all(session, semaphore, items)
+
+    added = insert_all(rows)
+
+    for row in added:
+        print(f"✅ Added ({row['status']}): {row['title']}")
+
+    print(f"\n🎉 DONE. Total added: {len(added)}")
+
+def main():
+    asyncio.run(run())
 
 # =============================
 # RUN
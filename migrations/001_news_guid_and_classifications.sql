@@ -0,0 +1,17 @@
+-- يجب تطبيقه على Supabase قبل دمج/تشغيل main.py الذي يعتمد على guid
+-- (SQL Editor في لوحة Supabase أو psql). آمن لإعادة التشغيل.
+
+-- معرّف الخبر من الخلاصة (guid/id أو الرابط)، فريد داخل المصدر فقط.
+-- الصفوف القديمة تبقى guid = NULL ولا تتعارض مع الفهرس الفريد.
+ALTER TABLE news ADD COLUMN IF NOT EXISTS guid text;
+
+-- مطلوب لـ upsert(on_conflict="source_id,guid") في insert_all()
+CREATE UNIQUE INDEX IF NOT EXISTS news_source_guid_key
+    ON news (source_id, guid);
+
+-- كاش التصنيفات حسب hash أول MAX_CHARS من النص
+-- مطلوب لـ upsert(on_conflict="content_hash") في store_predictions()
+CREATE TABLE IF NOT EXISTS classifications (
+    content_hash text PRIMARY KEY,
+    prediction text NOT NULL
+);